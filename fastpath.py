@@ -0,0 +1,37 @@
+import math
+
+import numba
+import numpy as np
+
+from telemetry import DTYPE
+
+EARTH_RADIUS_M = 6371000.0
+
+@numba.njit(cache=True, fastmath=True)
+def haversine_nearest(lats, lons, used, qlat, qlon):
+    """Row index and distance (m) of the used row nearest to (qlat, qlon), -1 if none"""
+    qlat_r = math.radians(qlat)
+    qlon_r = math.radians(qlon)
+    cos_qlat = math.cos(qlat_r)
+    best = -1
+    best_a = 2.0  # a est dans [0, 1]
+    for i in range(lats.shape[0]):
+        if not used[i]:
+            continue
+        lat_r = math.radians(lats[i])
+        dlat = lat_r - qlat_r
+        dlon = math.radians(lons[i]) - qlon_r
+        a = math.sin(dlat * 0.5) ** 2 + cos_qlat * math.cos(lat_r) * math.sin(dlon * 0.5) ** 2
+        if a < best_a:
+            best_a = a
+            best = i
+    if best < 0:
+        return -1, 0.0
+    return best, 2.0 * EARTH_RADIUS_M * math.asin(math.sqrt(min(best_a, 1.0)))
+
+def _warm_up():
+    """Compile (or load from cache) the kernels for the LampTable column layout"""
+    rows = np.zeros(1, dtype=DTYPE)
+    haversine_nearest(rows['lat'], rows['lon'], rows['used'], 0.0, 0.0)
+
+_warm_up()
@@ -1,14 +1,44 @@
-from flask import Flask, request, jsonify
+import eventlet
+eventlet.monkey_patch()
+
+from flask import Flask, request
+from flask.sessions import SessionInterface
 from flask_socketio import SocketIO, emit, join_room, leave_room
 from flask_cors import CORS
+from collections import OrderedDict
+from dataclasses import dataclass
 import logging
+import math
 import datetime
+import functools
+import hmac
 import os
+import sys
+import threading
+import time
+from typing import Optional, Union
+import msgspec
+import orjson
+
+from fastpath import haversine_nearest
+from telemetry import LampTable
 
 # Configuration
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'votre_cle_secrete_lampadaire_2024')
 
+# ✅ API sans état : pas de cookie de session à décoder/signer à chaque requête
+class NullSessionInterface(SessionInterface):
+    """Session interface that never loads nor saves a session"""
+
+    def open_session(self, app, request):
+        return None
+
+    def save_session(self, app, session, response):
+        return None
+
+app.session_interface = NullSessionInterface()
+
 # ✅ CORS amélioré pour Android
 CORS(app, resources={
     r"/*": {
@@ -18,37 +48,233 @@ CORS(app, resources={
     }
 })
 
-# ✅ Configuration SocketIO optimisée pour Render + Android
+# ✅ Encodeur JSON orjson pour les paquets Socket.IO/Engine.IO
+class OrjsonPacketJSON:
+    """json-module shim backed by orjson for python-socketio packets"""
+
+    @staticmethod
+    def dumps(obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    @staticmethod
+    def loads(s, **kwargs):
+        return orjson.loads(s)
+
+# Plusieurs workers : SOCKETIO_MESSAGE_QUEUE=redis://... (paquet redis requis)
+SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+
+# DEBUG_SIO=1 pour réactiver les logs Socket.IO/Engine.IO
+SIO_DEBUG = bool(os.environ.get('DEBUG_SIO'))
+
+# ✅ Configuration SocketIO optimisée pour Render + Android (eventlet = vrai transport WebSocket)
 socketio = SocketIO(
     app, 
     cors_allowed_origins="*",
-    async_mode='threading',
-    logger=True,
-    engineio_logger=True,
+    async_mode='eventlet',
+    logger=SIO_DEBUG,  # Logs Socket.IO/Engine.IO trop verbeux (ping/pong) en production
+    engineio_logger=SIO_DEBUG,
     ping_timeout=120,  # Augmenté pour connexions lentes
     ping_interval=25,
-    max_http_buffer_size=1e8,  # Augmentation buffer
+    # Taille max d'un message entrant : les payloads ESP32 font moins de 1 Ko
+    max_http_buffer_size=int(os.environ.get('MAX_HTTP_BUFFER_SIZE', 65536)),
     transports=['websocket', 'polling'],  # Support fallback polling
-    always_connect=True
+    always_connect=True,
+    json=OrjsonPacketJSON,
+    message_queue=SOCKETIO_MESSAGE_QUEUE,
+    # 'msgpack' = trames binaires plus compactes (clients avec parser msgpack requis)
+    serializer=os.environ.get('SIO_SERIALIZER', 'default')
 )
 
+# Émission vers tous les clients du namespace /lampadaires
+emit_lamp = functools.partial(socketio.emit, namespace='/lampadaires', to='lampadaires')
+
 # Configuration des logs améliorée
 logging.basicConfig(
-    level=logging.INFO,
+    level=os.environ.get('LOG_LEVEL', 'WARNING').upper(),
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
 
-# Stockage temporaire
-connected_lampadaires = {}
+# Stockage temporaire (LRU borné : les lampadaires les plus anciens sont oubliés)
+MAX_LAMPADAIRES = int(os.environ.get('MAX_LAMPADAIRES', 10000))
+connected_lampadaires = OrderedDict()
+lamp_table = LampTable(MAX_LAMPADAIRES)  # Colonnes NumPy pour les requêtes agrégées
 connected_clients = {}
 esp_status = {}
+room_names = {}  # str(lampadaire_id) -> nom de room interné
+valid_tokens = {}  # lampadaire_id -> token attendu (bytes), rempli au premier succès (borné)
+
+# Verrou unique pour les opérations composées sur l'état partagé
+# (les opérations dict simples, atomiques, s'en passent)
+_state_lock = threading.RLock()
+
+# Nombre maximal de diffusions en cours (back-pressure sur les requêtes HTTP)
+MAX_CONCURRENT_BROADCASTS = int(os.environ.get('MAX_CONCURRENT_BROADCASTS', 100))
+_broadcast_slots = threading.BoundedSemaphore(MAX_CONCURRENT_BROADCASTS)
+BROADCAST_SLOT_TIMEOUT = float(os.environ.get('BROADCAST_SLOT_TIMEOUT', 2.0))  # secondes
+
+# Snapshot de l'état envoyé aux nouveaux clients (None = à reconstruire)
+_snapshot_cache = None
+
+# Cache du timestamp ISO (rafraîchi au plus toutes les 1 ms)
+_ts_cache = (0.0, '')
+
+# Réponses invariantes pré-sérialisées
+ERR_INVALID_JSON = orjson.dumps({'error': 'JSON invalide'})
+ERR_MISSING_ID = orjson.dumps({'error': 'ID lampadaire requis'})
+ERR_MISSING_POSITION = orjson.dumps({'error': 'Paramètres lat et lon requis'})
+ERR_INVALID_POSITION = orjson.dumps({'error': 'Position invalide (lat -90..90, lon -180..180)'})
+ERR_NO_LAMPADAIRE = orjson.dumps({'error': 'Aucun lampadaire connu'})
+ERR_INVALID_THRESHOLD = orjson.dumps({'error': 'Paramètre threshold invalide (0-255)'})
+AUTH_MISSING = {'success': False, 'message': 'ID ou token manquant'}
+AUTH_INVALID = {'success': False, 'message': 'Token invalide'}
+
+# =================== SCHÉMAS ===================
+
+class LampUpdate(msgspec.Struct):
+    """Lampadaire payload posted by ESP32 (unknown fields are ignored)"""
+    id: Union[str, int, None] = None
+    latitude: float = 0.0
+    longitude: float = 0.0
+    etat: Optional[str] = 'OK'
+    batterie: Union[int, float] = 100
+    led_status: bool = False
+    luminosite: Union[int, float] = 0
+    pir_detection: bool = False
+    derniere_remontee: Optional[str] = None
+    lieu: Optional[str] = ''
+
+@dataclass(slots=True)
+class ClientInfo:
+    """Socket.IO client connected to /lampadaires"""
+    sid: str
+    connected_at: str
+    remote_addr: Optional[str]
+    last_heartbeat: Optional[int] = None  # time.monotonic_ns()
+
+# =================== HELPERS ===================
+
+def now_iso():
+    """Current local time as ISO string, memoized for 1 ms"""
+    global _ts_cache
+    t = time.time()
+    cached_t, cached_iso = _ts_cache
+    if abs(t - cached_t) > 0.001:  # abs() : l'horloge murale peut reculer (NTP)
+        cached_iso = datetime.datetime.fromtimestamp(t).isoformat()
+        _ts_cache = (t, cached_iso)
+    return cached_iso
+
+def ojson(obj, status=200):
+    """Build a JSON response serialized with orjson (bytes are sent as is)"""
+    body = obj if isinstance(obj, bytes) else orjson.dumps(obj)
+    return app.response_class(body, status=status, mimetype='application/json')
+
+def _emit_and_release(event, payload):
+    """Background broadcast task: emit, log failures, free the slot"""
+    try:
+        emit_lamp(event, payload)
+    except Exception as e:
+        logger.error("❌ Erreur broadcast %s: %s", event, e)
+    finally:
+        _broadcast_slots.release()
+
+def broadcast(event, payload):
+    """Fan out an event to all clients without delaying the HTTP response"""
+    # Personne à prévenir (les autres workers, eux, passent par la file)
+    if not connected_clients and not SOCKETIO_MESSAGE_QUEUE:
+        return
+    # Attend un peu si trop de diffusions sont en vol (mémoire bornée), puis abandonne
+    if not _broadcast_slots.acquire(timeout=BROADCAST_SLOT_TIMEOUT):
+        logger.warning("⚠️ Broadcast %s ignoré: %d diffusions déjà en cours", event, MAX_CONCURRENT_BROADCASTS)
+        return
+    try:
+        socketio.start_background_task(_emit_and_release, event, payload)
+    except Exception:
+        _broadcast_slots.release()
+        raise
+
+def read_json():
+    """Parse the request body with orjson, None if it is not a JSON object"""
+    try:
+        data = orjson.loads(request.get_data(cache=False))
+    except orjson.JSONDecodeError:
+        return None
+    return data if isinstance(data, dict) else None
+
+def build_lampadaire(lamp, now):
+    """Stored/broadcast record of a decoded lampadaire update"""
+    if not lamp.derniere_remontee:
+        lamp.derniere_remontee = now
+    data = msgspec.structs.asdict(lamp)
+    data['server_timestamp'] = now
+    data['synced'] = True
+    return data
+
+def store_lampadaire(lamp_id, data):
+    """Store the latest lampadaire record, evicting the least recently updated"""
+    global _snapshot_cache
+    # Conversion des colonnes hors du verrou : seules les écritures y restent
+    values = lamp_table.row_values(data, time.time())
+    with _state_lock:
+        connected_lampadaires[lamp_id] = data
+        connected_lampadaires.move_to_end(lamp_id)
+        if len(connected_lampadaires) > MAX_LAMPADAIRES:
+            evicted_id, _ = connected_lampadaires.popitem(last=False)
+            lamp_table.remove(evicted_id)
+        lamp_table.update(lamp_id, values)
+        _snapshot_cache = None
+
+def lampadaires_snapshot():
+    """Snapshot payload of all lampadaires, rebuilt only after an update"""
+    global _snapshot_cache
+    with _state_lock:
+        snapshot = _snapshot_cache
+        if snapshot is None:
+            snapshot = {
+                'type': 'lampadaire_snapshot',
+                'lampadaires': list(connected_lampadaires.values())
+            }
+            _snapshot_cache = snapshot
+    return snapshot
+
+def room_for(lampadaire_id):
+    """Interned room name of a lampadaire"""
+    key = str(lampadaire_id)  # les ids JSON peuvent être des listes/objets non hashables
+    room = room_names.get(key)
+    if room is None:
+        room = sys.intern(f"lampadaire_{key}")
+        if len(room_names) < MAX_LAMPADAIRES:
+            room_names[key] = room
+    return room
+
+def check_token(lampadaire_id, token):
+    """Constant-time check of a lampadaire token"""
+    if not isinstance(token, str):
+        return False
+    key = str(lampadaire_id)
+    expected = valid_tokens.get(key)
+    if expected is None:
+        expected = f"lampadaire_token_{key}".encode()
+    if not hmac.compare_digest(token.encode(), expected):
+        return False
+    if len(valid_tokens) < MAX_LAMPADAIRES:
+        valid_tokens[key] = expected
+    return True
+
+def parse_event(data):
+    """Decode WebSocket payloads sent as stringified JSON"""
+    if isinstance(data, (str, bytes)):
+        try:
+            data = orjson.loads(data)
+        except orjson.JSONDecodeError:
+            return {}
+    return data if isinstance(data, dict) else {}
 
 # =================== HTTP ROUTES ===================
 
 @app.route('/', methods=['GET'])
 def index():
-    return jsonify({
+    return ojson({
         'message': 'Serveur Lampadaires Solaires Actif',
         'version': '2.1',
         'status': 'healthy',
@@ -56,6 +282,8 @@ def index():
             'health': '/api/health',
             'update': '/api/lampadaire/update',
             'alert': '/api/alert',
+            'nearest': '/api/lampadaire/nearest',
+            'low_battery': '/api/lampadaire/low-battery',
             'websocket': '/lampadaires'
         },
         'stats': {
@@ -68,11 +296,11 @@ def index():
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Health check pour Render"""
-    return jsonify({
+    return ojson({
         'status': 'healthy',
-        'timestamp': datetime.datetime.now().isoformat(),
+        'timestamp': now_iso(),
         'server': 'operational'
-    }), 200
+    }, 200)
 
 @app.route('/api/lampadaire/update', methods=['POST', 'OPTIONS'])
 def update_lampadaire():
@@ -81,34 +309,84 @@ def update_lampadaire():
         return '', 200
         
     try:
-        data = request.json
-        lamp_id = data.get('id')
+        try:
+            # strict=False : coerce "48.85" -> 48.85, 0/1 -> bool, comme le firmware les envoie
+            lamp = msgspec.json.decode(request.get_data(cache=False), type=LampUpdate, strict=False)
+        except msgspec.ValidationError as e:
+            return ojson({'error': f'Données lampadaire invalides: {e}'}, 400)
+        except msgspec.DecodeError:
+            return ojson(ERR_INVALID_JSON, 400)
+        lamp_id = lamp.id
         
         if not lamp_id:
-            return jsonify({'error': 'ID lampadaire requis'}), 400
+            return ojson(ERR_MISSING_ID, 400)
         
-        data['server_timestamp'] = datetime.datetime.now().isoformat()
-        data['synced'] = True
+        data = build_lampadaire(lamp, now_iso())
         
-        connected_lampadaires[lamp_id] = data
+        store_lampadaire(lamp_id, data)
         
-        # Broadcast via WebSocket
-        socketio.emit('lampadaire_update', {
+        # Broadcast via WebSocket (en parallèle de la réponse HTTP)
+        broadcast('lampadaire_update', {
             'type': 'lampadaire_update',
             'lampadaire': data
-        }, namespace='/lampadaires', broadcast=True)
+        })
         
-        logger.info(f"✅ Lampadaire {lamp_id} mis à jour: {data.get('lieu', 'N/A')}")
+        logger.debug("✅ Lampadaire %s mis à jour: %s", lamp_id, lamp.lieu or 'N/A')
         
-        return jsonify({
+        return ojson({
             'success': True,
             'message': 'Lampadaire mis à jour',
             'lampadaire_id': lamp_id
-        }), 200
+        }, 200)
         
     except Exception as e:
-        logger.error(f"❌ Erreur update lampadaire: {e}")
-        return jsonify({'error': str(e)}), 500
+        logger.error("❌ Erreur update lampadaire: %s", e)
+        return ojson({'error': str(e)}, 500)
+
+@app.route('/api/lampadaire/nearest', methods=['GET'])
+def nearest_lampadaire():
+    """Nearest known lampadaire to a GPS position"""
+    lat = request.args.get('lat', type=float)
+    lon = request.args.get('lon', type=float)
+    
+    if lat is None or lon is None:
+        return ojson(ERR_MISSING_POSITION, 400)
+    
+    # Le noyau fastmath suppose des valeurs finies : rejeter nan/inf et hors bornes avant
+    if not (math.isfinite(lat) and math.isfinite(lon) and -90 <= lat <= 90 and -180 <= lon <= 180):
+        return ojson(ERR_INVALID_POSITION, 400)
+    
+    with _state_lock:
+        rows = lamp_table.rows
+        row, distance = haversine_nearest(rows['lat'], rows['lon'], rows['used'], lat, lon)
+        lamp = connected_lampadaires.get(lamp_table.ids[row]) if row >= 0 else None
+    
+    if lamp is None:
+        return ojson(ERR_NO_LAMPADAIRE, 404)
+    
+    return ojson({
+        'lampadaire': lamp,
+        'distance_m': round(distance, 1)
+    }, 200)
+
+@app.route('/api/lampadaire/low-battery', methods=['GET'])
+def low_battery_lampadaires():
+    """Known lampadaires whose battery is below a threshold (default 20)"""
+    threshold = 20
+    if 'threshold' in request.args:
+        threshold = request.args.get('threshold', type=int)
+    
+    if threshold is None or not 0 <= threshold <= 255:
+        return ojson(ERR_INVALID_THRESHOLD, 400)
+    
+    with _state_lock:
+        lamps = [connected_lampadaires[lamp_id] for lamp_id in lamp_table.low_battery(threshold)]
+    
+    return ojson({
+        'threshold': threshold,
+        'count': len(lamps),
+        'lampadaires': lamps
+    }, 200)
 
 @app.route('/api/alert', methods=['POST', 'OPTIONS'])
 def create_alert():
@@ -117,26 +395,28 @@ def create_alert():
         return '', 200
         
     try:
-        data = request.json
-        data['created_at'] = datetime.datetime.now().isoformat()
+        data = read_json()
+        if data is None:
+            return ojson(ERR_INVALID_JSON, 400)
+        data['created_at'] = now_iso()
         data['server_received'] = True
         
-        socketio.emit('new_alert', {
+        broadcast('new_alert', {
             'type': 'new_alert',
             'alert': data
-        }, namespace='/lampadaires', broadcast=True)
+        })
         
-        logger.warning(f"⚠️ Alerte: {data.get('type')} - Lampadaire #{data.get('lampadaire_id')}")
+        logger.warning("⚠️ Alerte: %s - Lampadaire #%s", data.get('type'), data.get('lampadaire_id'))
         
-        return jsonify({
+        return ojson({
             'success': True,
             'message': 'Alerte reçue',
             'alert_type': data.get('type')
-        }), 200
+        }, 200)
         
     except Exception as e:
-        logger.error(f"❌ Erreur create alert: {e}")
-        return jsonify({'error': str(e)}), 500
+        logger.error("❌ Erreur create alert: %s", e)
+        return ojson({'error': str(e)}, 500)
 
 # =================== WEBSOCKET EVENTS ===================
 
@@ -144,59 +424,44 @@ def create_alert():
 def handle_connect():
     """Handle client connections"""
     client_id = request.sid
-    client_info = {
-        'sid': client_id,
-        'connected_at': datetime.datetime.now().isoformat(),
-        'remote_addr': request.remote_addr
-    }
-    connected_clients[client_id] = client_info
+    connected_clients[client_id] = ClientInfo(client_id, now_iso(), request.remote_addr)
     
-    logger.info(f"🔌 Client connecté: {client_id} (Total: {len(connected_clients)})")
+    logger.info("🔌 Client connecté: %s (Total: %d)", client_id, len(connected_clients))
     
     join_room('lampadaires')
     
     emit('status', {
         'message': 'Connecté au serveur',
         'connected_lampadaires': len(connected_lampadaires),
-        'timestamp': datetime.datetime.now().isoformat()
+        'timestamp': now_iso()
     })
     
-    # Envoyer l'état actuel des lampadaires
+    # Envoyer l'état actuel des lampadaires en une seule trame
     if connected_lampadaires:
-        for lamp_id, lamp_data in connected_lampadaires.items():
-            emit('lampadaire_update', {
-                'type': 'lampadaire_update',
-                'lampadaire': lamp_data
-            })
+        emit('lampadaire_snapshot', lampadaires_snapshot())
 
 @socketio.on('disconnect', namespace='/lampadaires')
 def handle_disconnect():
     """Handle client disconnections"""
     client_id = request.sid
-    if client_id in connected_clients:
-        del connected_clients[client_id]
+    connected_clients.pop(client_id, None)
     
-    logger.info(f"🔌 Client déconnecté: {client_id} (Restant: {len(connected_clients)})")
+    logger.info("🔌 Client déconnecté: %s (Restant: %d)", client_id, len(connected_clients))
 
 @socketio.on('auth', namespace='/lampadaires')
 def handle_authenticate(data):
     """Authenticate ESP32/Android clients"""
     try:
+        data = parse_event(data)
         lampadaire_id = data.get('lampadaire_id')
         token = data.get('token')
         
         if not lampadaire_id or not token:
-            emit('authenticated', {
-                'success': False,
-                'message': 'ID ou token manquant'
-            })
+            emit('authenticated', AUTH_MISSING)
             return
         
-        expected_token = f"lampadaire_token_{lampadaire_id}"
-        
-        if token == expected_token:
-            room_name = f"lampadaire_{lampadaire_id}"
-            join_room(room_name)
+        if check_token(lampadaire_id, token):
+            join_room(room_for(lampadaire_id))
             
             emit('authenticated', {
                 'success': True,
@@ -204,21 +469,19 @@ def handle_authenticate(data):
                 'message': 'Authentifié avec succès'
             })
             
-            logger.info(f"✅ Lampadaire #{lampadaire_id} authentifié")
+            logger.info("✅ Lampadaire #%s authentifié", lampadaire_id)
         else:
-            emit('authenticated', {
-                'success': False,
-                'message': 'Token invalide'
-            })
+            emit('authenticated', AUTH_INVALID)
             
     except Exception as e:
-        logger.error(f"❌ Erreur auth: {e}")
+        logger.error("❌ Erreur auth: %s", e)
         emit('authenticated', {'success': False, 'message': str(e)})
 
 @socketio.on('command', namespace='/lampadaires')
 def handle_command(data):
     """Handle commands from Android app to ESP32"""
     try:
+        data = parse_event(data)
         lamp_id = data.get('lamp_id')
         command = data.get('command')
         
@@ -226,30 +489,32 @@ def handle_command(data):
             logger.error("❌ Commande invalide")
             return
         
-        room_name = f"lampadaire_{lamp_id}"
-        
         emit('command', {
             'type': 'command',
             'command': command,
-            'timestamp': datetime.datetime.now().isoformat()
-        }, room=room_name)
+            'timestamp': now_iso()
+        }, room=room_for(lamp_id))
         
-        logger.info(f"📡 Commande '{command}' envoyée au lampadaire #{lamp_id}")
+        logger.debug("📡 Commande '%s' envoyée au lampadaire #%s", command, lamp_id)
         
     except Exception as e:
-        logger.error(f"❌ Erreur command: {e}")
+        logger.error("❌ Erreur command: %s", e)
 
 @socketio.on('heartbeat', namespace='/lampadaires')
 def handle_heartbeat(data):
     """Handle heartbeat from clients"""
     client_id = request.sid
-    if client_id in connected_clients:
-        connected_clients[client_id]['last_heartbeat'] = datetime.datetime.now().isoformat()
+    client = connected_clients.get(client_id)
+    if client is not None:
+        client.last_heartbeat = time.monotonic_ns()
     
-    emit('heartbeat_ack', {'timestamp': datetime.datetime.now().isoformat()})
+    # Horloge murale en secondes epoch, formatée côté client si besoin
+    emit('heartbeat_ack', {'t': time.time()})
 
 # =================== DÉMARRAGE SERVEUR ===================
 
+# En production (Render) : gunicorn -k eventlet -w 1 server:app
+# Pour plus d'un worker : transport WebSocket seul (ou sessions collantes) + SOCKETIO_MESSAGE_QUEUE
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 10000))
     
@@ -265,6 +530,5 @@ if __name__ == '__main__':
         app,
         host='0.0.0.0',
         port=port,
-        debug=False,
-        allow_unsafe_werkzeug=True
+        debug=False
     )
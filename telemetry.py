@@ -0,0 +1,76 @@
+import math
+
+import numpy as np
+
+# Colonnes numériques de télémétrie (une ligne par lampadaire)
+DTYPE = np.dtype([
+    ('lat', 'f4'),
+    ('lon', 'f4'),
+    ('batterie', 'u1'),
+    ('luminosite', 'u2'),
+    ('led', '?'),
+    ('pir', '?'),
+    ('ts', 'f8'),
+    ('used', '?')
+])
+
+def _number(value, default=0.0):
+    """Coerce a payload value to a finite float, default otherwise"""
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return default
+    return value if math.isfinite(value) else default
+
+def _clamp(value, high):
+    """Coerce a payload value to an int within [0, high]"""
+    return min(max(int(_number(value)), 0), high)
+
+class LampTable:
+    """Structure-of-arrays store of lampadaire telemetry keyed by lampadaire id"""
+
+    def __init__(self, capacity):
+        self.rows = np.zeros(capacity, dtype=DTYPE)
+        self.ids = [None] * capacity
+        self.id_to_row = {}
+        self._free = list(range(capacity - 1, -1, -1))
+
+    @staticmethod
+    def row_values(data, ts):
+        """Row tuple of the numeric fields of a lampadaire record"""
+        return (
+            _number(data.get('latitude')),
+            _number(data.get('longitude')),
+            _clamp(data.get('batterie'), 255),
+            _clamp(data.get('luminosite'), 65535),
+            bool(data.get('led_status')),
+            bool(data.get('pir_detection')),
+            ts,
+            True
+        )
+
+    def update(self, lamp_id, values):
+        """Write a row tuple (see row_values) for a lampadaire"""
+        row = self.id_to_row.get(lamp_id)
+        if row is None:
+            row = self._free.pop()
+            self.id_to_row[lamp_id] = row
+            self.ids[row] = lamp_id
+        self.rows[row] = values
+
+    def remove(self, lamp_id):
+        """Release the row of a lampadaire"""
+        row = self.id_to_row.pop(lamp_id, None)
+        if row is None:
+            return
+        self.rows['used'][row] = False
+        self.ids[row] = None
+        self._free.append(row)
+
+    def ids_where(self, mask):
+        """Lampadaire ids of the used rows selected by a boolean mask"""
+        return [self.ids[row] for row in np.flatnonzero(mask & self.rows['used'])]
+
+    def low_battery(self, threshold=20):
+        """Ids of the lampadaires whose battery is below threshold"""
+        return self.ids_where(self.rows['batterie'] < threshold)